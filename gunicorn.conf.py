@@ -0,0 +1,13 @@
+import os
+
+# gevent workers overlap the DB and network waits of many requests per process.
+# The gevent worker class monkey-patches the standard library itself when it boots.
+worker_class = "gevent"
+workers = int(os.environ.get("WEB_CONCURRENCY", 4))
+worker_connections = 1000
+
+
+def post_fork(server, worker):
+    # psycopg2 is a C extension, so make it yield to gevent while waiting on Postgres
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
@@ -1,16 +1,30 @@
-from flask import Flask, render_template, redirect, url_for, flash, abort
+from flask import Flask, render_template, redirect, url_for, flash, abort, g, request, has_request_context
 from flask_bootstrap import Bootstrap
 from flask_ckeditor import CKEditor
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin, login_user, LoginManager, login_required, current_user, logout_user
 from flask_gravatar import Gravatar
-from sqlalchemy.orm import relationship
+from flask_caching import Cache
+from flask_compress import Compress
+from sqlalchemy.orm import relationship, joinedload, selectinload, defer, raiseload
+from sqlalchemy import event, insert
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Engine
 from datetime import date, datetime
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.security import check_password_hash
+from argon2 import PasswordHasher
+from argon2.exceptions import VerificationError, InvalidHash
 from forms import CreatePostForm, RegisterForm, LoginForm, CommentForm, ContactForm
 from functools import wraps
+from jinja2 import FileSystemBytecodeCache
 from dotenv import load_dotenv
+from celery import Celery
+from email.message import EmailMessage
 import smtplib
+import html
+import re
+import queue
+import time
 import os
 
 load_dotenv()
@@ -20,6 +34,10 @@ MY_PASSWORD = os.environ.get('MY_PASSWORD')
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY')
+
+## CONNECT TO TASK QUEUE
+# Run the worker as a separate process: celery -A main.celery worker
+celery = Celery(app.name, broker=os.environ.get("CELERY_BROKER_URL", "redis://localhost:6379/0"))
 ckeditor = CKEditor(app)
 Bootstrap(app)
 gravatar = Gravatar(
@@ -33,8 +51,73 @@ gravatar = Gravatar(
     base_url=None
 )
 
+## RESPONSE COMPRESSION
+app.config['COMPRESS_BR_LEVEL'] = 4
+Compress(app)
+
+# Flask-Compress appends the encoding to an existing ETag ("<hash>:gzip")
+COMPRESSED_ETAG_RE = re.compile(r':(?:gzip|br|deflate)"')
+
+
+# after_request hooks run in reverse order, so registering this after Compress(app) means
+# it hashes the uncompressed body. gzip output embeds a timestamp, so hashing the
+# compressed body would give a new ETag every second.
+@app.after_request
+def conditional_homepage(response):
+    # The cached homepage is never a 304, those are only built here
+    if request.endpoint == "get_all_posts" and response.status_code == 200:
+        response.add_etag()
+        # Compare against the tag the browser got back with the encoding suffix removed
+        if_none_match = COMPRESSED_ETAG_RE.sub('"', request.headers.get("If-None-Match", ""))
+        response.make_conditional(dict(request.environ, HTTP_IF_NONE_MATCH=if_none_match))
+    return response
+
+## TEMPLATE BYTECODE CACHE
+# Compiled templates are shared between worker processes so each one doesn't re-parse them.
+# Template auto-reload already follows app.debug, so production skips the mtime checks.
+# The default directory is a private per-user one that Jinja checks is mode 0700.
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache()
+
+## CONNECT TO CACHE
+redis_url = os.environ.get("REDIS_URL")
+if redis_url:
+    cache = Cache(app, config={'CACHE_TYPE': 'RedisCache', 'CACHE_REDIS_URL': redis_url})
+else:
+    # An in-process cache would only be cleared in the worker that handled a write,
+    # so without a shared Redis nothing is cached.
+    cache = Cache(app, config={'CACHE_TYPE': 'NullCache'})
+# Key the cached homepage is stored under, delete it whenever the post list changes.
+HOMEPAGE_CACHE_KEY = "view//"
+
 admin_id = 1
 
+# CKEditor wraps the contact message in a <p> tag
+MESSAGE_RE = re.compile(r"<p>(.*?)</p>", re.DOTALL)
+
+## PASSWORD HASHING
+# Argon2id hashes are ~97 characters, which still fits in User.password.
+password_hasher = PasswordHasher(time_cost=2, memory_cost=64 * 1024, parallelism=2)
+
+
+def verify_password(user, password):
+    # Accounts created before the switch to argon2 still have werkzeug pbkdf2 hashes
+    if user.password.startswith("pbkdf2:"):
+        if not check_password_hash(user.password, password):
+            return False
+        user.password = password_hasher.hash(password)
+        db.session.commit()
+        return True
+
+    try:
+        password_hasher.verify(user.password, password)
+    except (VerificationError, InvalidHash):
+        return False
+
+    if password_hasher.check_needs_rehash(user.password):
+        user.password = password_hasher.hash(password)
+        db.session.commit()
+    return True
+
 ## CONNECT TO DB
 heroku_url = os.environ.get("DATABASE_URL", "sqlite:///blog.db")  # or other relevant config var
 if heroku_url.startswith("postgres://"):
@@ -43,21 +126,84 @@ if heroku_url.startswith("postgres://"):
 app.config['SQLALCHEMY_DATABASE_URI'] = heroku_url
 # app.config['SQLALCHEMY_DATABASE_URI'] = "sqlite:///blog.db"
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Pool settings only apply to server databases like Heroku Postgres; SQLite doesn't use a QueuePool.
+# (pool_size + max_overflow) * gunicorn workers has to stay <= the database's max_connections,
+# so by default DB_MAX_CONNECTIONS (20 on the small Heroku plans) is split between the workers.
+# WEB_CONCURRENCY is the same setting gunicorn.conf.py reads for its worker count.
+if not heroku_url.startswith("sqlite"):
+    web_workers = int(os.environ.get("WEB_CONCURRENCY", 4))
+    db_max_connections = int(os.environ.get("DB_MAX_CONNECTIONS", 20))
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'pool_size': int(os.environ.get("DB_POOL_SIZE", max(db_max_connections // web_workers, 1))),
+        'max_overflow': int(os.environ.get("DB_MAX_OVERFLOW", 0)),
+        'pool_pre_ping': True,
+        'pool_recycle': 1800,
+        'pool_use_lifo': True,
+    }
 db = SQLAlchemy(app)
 login_manager = LoginManager()
 login_manager.init_app(app)
 
 
+@app.teardown_appcontext
+def shutdown_session(exception=None):
+    # Return the connection to the pool at the end of every request
+    db.session.remove()
+
+
+## QUERY CHECKS (development/testing only)
+def debug_queries():
+    return app.debug or app.testing
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def count_queries(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and debug_queries():
+        g.query_count = g.get("query_count", 0) + 1
+
+
+@app.after_request
+def log_query_count(response):
+    if debug_queries():
+        app.logger.debug("%s ran %d queries", request.path, g.get("query_count", 0))
+    return response
+
+
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    # Session.get uses the identity map, and the comment loader can reuse the result
+    user = db.session.get(User, int(user_id))
+    if user is not None and "user_loader" in g:
+        g.user_loader[user.id] = user
+    return user
+
+
+def current_user_id():
+    # Cache the id for the rest of the request
+    if "current_user_id" not in g:
+        g.current_user_id = current_user.id
+    return g.current_user_id
+
+
+def upsert(model):
+    # Heroku Postgres and the local SQLite database both support INSERT ... ON CONFLICT
+    dialect = postgresql if db.engine.dialect.name == "postgresql" else sqlite
+    return dialect.insert(model)
+
+
+def get_post_or_404(post_id, options=()):
+    # Session.get checks the identity map before going to the database
+    post = db.session.get(BlogPost, post_id, options=options)
+    if post is None:
+        abort(404)
+    return post
 
 
 ## Admin-only decorator
 def admin_only(func):
     @wraps(func)
     def decorated_function(*args, **kwargs):
-        if current_user.id != admin_id:
+        if current_user_id() != admin_id:
             #If id is not 1 then return abort with 403 error
             return abort(403)
         #Otherwise continue with the route function
@@ -65,6 +211,9 @@ def admin_only(func):
     return decorated_function
 
 
+## Existing Postgres databases need the schema changes in migrations/postgres.sql
+
+
 ## CONFIGURE USER TABLE
 class User(UserMixin, db.Model):
     __tablename__ = "users"
@@ -85,14 +234,15 @@ class BlogPost(db.Model):
     id = db.Column(db.Integer, primary_key=True)
 
     # Create Foreign Key, "users.id" the users refers to the tablename of User.
-    author_id = db.Column(db.Integer, db.ForeignKey("users.id"))
+    author_id = db.Column(db.Integer, db.ForeignKey("users.id"), index=True)
 
     # Create reference to the User object, the "posts" refers to the posts property in the User class.
     author = relationship("User", back_populates="posts")
 
     title = db.Column(db.String(250), unique=True, nullable=False)
     subtitle = db.Column(db.String(250), nullable=False)
-    date = db.Column(db.String(250), nullable=False)
+    # Native DATE, older databases need migrations/postgres.sql before they can read it
+    date = db.Column(db.Date, nullable=False, index=True)
     body = db.Column(db.Text, nullable=False)
     img_url = db.Column(db.String(250), nullable=False)
     comments = relationship("Comment", back_populates="parent_post")
@@ -102,21 +252,140 @@ class BlogPost(db.Model):
 class Comment(db.Model):
     __tablename__ = "comments"
     id = db.Column(db.Integer, primary_key=True)
-    author_id = db.Column(db.Integer, db.ForeignKey("users.id"))
+    author_id = db.Column(db.Integer, db.ForeignKey("users.id"), index=True)
     comment_author = relationship("User", back_populates="comments")
-    post_id = db.Column(db.Integer, db.ForeignKey("blog_posts.id"))
+    post_id = db.Column(db.Integer, db.ForeignKey("blog_posts.id"), index=True)
     parent_post = relationship("BlogPost", back_populates="comments")
     text = db.Column(db.Text, nullable=False)
-    date = db.Column(db.String(250), nullable=False)
-    time = db.Column(db.String(250), nullable=False)
+    date = db.Column(db.Date, nullable=False)
+    time = db.Column(db.Time, nullable=False)
 
 
 # db.create_all()
 
 
+## TEMPLATE FILTERS
+@app.template_filter("long_date")
+def long_date(value):
+    # Dates are stored as native DATE columns and only formatted for display.
+    # Posts and comments share a handful of dates, so format each one once per request.
+    formatted_dates = g.setdefault("formatted_dates", {})
+    if value not in formatted_dates:
+        formatted_dates[value] = value.strftime("%B %d, %Y")
+    return formatted_dates[value]
+
+
+@app.template_filter("clock_time")
+def clock_time(value):
+    return value.strftime("%X")
+
+
+## BATCHED USER LOADING
+@app.before_request
+def setup_user_loader():
+    # Request-scoped cache of User objects keyed by id
+    g.user_loader = {}
+
+
+def load_users(user_ids):
+    # Fetch every id we haven't seen yet this request with a single IN query
+    user_ids = list(user_ids)
+    missing = {user_id for user_id in user_ids if user_id not in g.user_loader}
+    if missing:
+        g.user_loader.update(dict.fromkeys(missing))
+        for user in User.query.filter(User.id.in_(missing)):
+            g.user_loader[user.id] = user
+    return [g.user_loader[user_id] for user_id in user_ids]
+
+
+@app.template_filter("comment_author")
+def comment_author(user_id):
+    return load_users([user_id])[0]
+
+
+## SMTP CONNECTION POOL
+# Logged-in connections are reused by the Celery worker so each email
+# doesn't pay for a fresh TCP + STARTTLS + login handshake.
+SMTP_POOL_SIZE = 4
+SMTP_IDLE_CHECK = 60
+smtp_pool = queue.Queue(maxsize=SMTP_POOL_SIZE)
+
+
+def open_smtp_connection():
+    connection = smtplib.SMTP("smtp.gmail.com", 587)
+    try:
+        connection.starttls()
+        connection.login(user=MY_EMAIL, password=MY_PASSWORD)
+    except Exception:
+        # Don't leak the socket when the task retries
+        connection.close()
+        raise
+    return connection
+
+
+def get_smtp_connection():
+    try:
+        connection, last_used = smtp_pool.get_nowait()
+    except queue.Empty:
+        return open_smtp_connection()
+
+    if time.monotonic() - last_used > SMTP_IDLE_CHECK:
+        # The server may have dropped an idle connection, check it's still alive
+        try:
+            code, _ = connection.noop()
+        except (smtplib.SMTPException, OSError):
+            code = None
+        if code != 250:
+            # Any reply other than 250 OK (e.g. 421 closing) means the connection is unusable
+            connection.close()
+            return open_smtp_connection()
+    return connection
+
+
+def release_smtp_connection(connection):
+    try:
+        smtp_pool.put_nowait((connection, time.monotonic()))
+    except queue.Full:
+        connection.quit()
+
+
+## BACKGROUND TASKS
+@celery.task(bind=True, autoretry_for=(smtplib.SMTPException,), retry_backoff=True, max_retries=5)
+def send_contact_email(self, name, email, message):
+    # EmailMessage encodes the body as UTF-8, sendmail() would only accept ASCII
+    msg = EmailMessage()
+    msg["Subject"] = "New Message from Walker's Blog"
+    msg["From"] = MY_EMAIL
+    msg["To"] = MY_EMAIL
+    msg.set_content(
+        f"Name: {name}\n"
+        f"Email: {email}\n"
+        f"Message: {message}"
+    )
+
+    connection = get_smtp_connection()
+    try:
+        connection.send_message(msg)
+    except smtplib.SMTPServerDisconnected:
+        # Don't put a dead connection back, the retry will open a new one
+        connection.close()
+        raise
+    finally:
+        if connection.sock is not None:
+            release_smtp_connection(connection)
+    print("Message sent!!")
+
+
 @app.route('/')
+@cache.cached(timeout=60, key_prefix=HOMEPAGE_CACHE_KEY, unless=lambda: current_user.is_authenticated)
 def get_all_posts():
-    posts = BlogPost.query.all()
+    # Load each post's author in the same query instead of one SELECT per post.
+    # The index never shows the body, so leave it out of the SELECT.
+    options = [defer(BlogPost.body), joinedload(BlogPost.author)]
+    if debug_queries():
+        # Fail loudly if the template starts touching a relationship we didn't load
+        options.append(raiseload("*"))
+    posts = BlogPost.query.options(*options).order_by(BlogPost.date.desc()).all()
     return render_template("index.html", all_posts=posts, admin_id=admin_id)
 
 
@@ -124,25 +393,22 @@ def get_all_posts():
 def register():
     form = RegisterForm()
     if form.validate_on_submit():
-        email_registered_already = User.query.filter_by(email=form.email.data).first()
-        if email_registered_already:
+        # Let the unique email constraint catch existing accounts instead of a separate SELECT
+        result = db.session.execute(
+            upsert(User).values(
+                email=form.email.data,
+                password=password_hasher.hash(form.password.data),
+                name=form.name.data
+            ).on_conflict_do_nothing(index_elements=["email"])
+        )
+        if result.rowcount == 0:
+            db.session.rollback()
             flash("You've already signed up with that email, log in instead!")
             return redirect(url_for("login"))
-
-
-        new_user = User(
-            email=form.email.data,
-            password=generate_password_hash(
-                form.password.data,
-                method="pbkdf2:sha256",
-                salt_length=8
-            ),
-            name = form.name.data
-        )
-
-        db.session.add(new_user)
         db.session.commit()
 
+        # login_user only needs the id, so there's no need to SELECT the row we just inserted
+        new_user = User(id=result.inserted_primary_key[0], email=form.email.data, name=form.name.data)
         login_user(new_user)
         return redirect(url_for("get_all_posts"))
     return render_template("register.html", form=form)
@@ -165,7 +431,7 @@ def login():
             flash("That email does not exist, please try again")
             return redirect(url_for("login"))
 
-        elif not check_password_hash(user.password, password):
+        elif not verify_password(user, password):
             # Password incorrect
             flash("Password incorrect, please try again")
             return redirect(url_for("login"))
@@ -185,7 +451,10 @@ def logout():
 
 @app.route("/post/<int:post_id>", methods=["GET", "POST"])
 def show_post(post_id):
-    requested_post = BlogPost.query.get(post_id)
+    requested_post = get_post_or_404(post_id, options=[
+        joinedload(BlogPost.author),
+        selectinload(BlogPost.comments)
+    ])
     form = CommentForm()
 #     print(post_comments.text)
 
@@ -195,16 +464,20 @@ def show_post(post_id):
             return redirect(url_for("login"))
 
         else:
-            new_comment=Comment(
-                author_id=current_user.id,
-                post_id=post_id,
-                text=form.comment.data,
-                date=date.today().strftime("%B %d, %Y"),
-                time=datetime.now().strftime("%X")
+            # Core insert skips the ORM unit of work, the new comment isn't used in this request
+            db.session.execute(
+                insert(Comment).values(
+                    author_id=current_user.id,
+                    post_id=post_id,
+                    text=form.comment.data,
+                    date=date.today(),
+                    time=datetime.now().time()
+                )
             )
-            db.session.add(new_comment)
             db.session.commit()
             return redirect(url_for("show_post", post_id=post_id))
+    # Prime the loader so the template's comment_author lookups don't query per comment
+    load_users({comment.author_id for comment in requested_post.comments})
     return render_template("post.html", post=requested_post, admin_id=admin_id, form=form)
 
 
@@ -219,21 +492,12 @@ def contact():
     if form.validate_on_submit():
         print(form.name.data)
         print(form.email.data)
-        message = form.message.data.split("<p>")[1].split("</p>")[0]
+        match = MESSAGE_RE.search(form.message.data)
+        message = html.unescape(match.group(1)) if match else form.message.data
         print(message)
 
-        with smtplib.SMTP("smtp.gmail.com", 587) as connection:
-            connection.starttls()
-            connection.login(user=MY_EMAIL, password=MY_PASSWORD)
-            connection.sendmail(
-                from_addr=MY_EMAIL,
-                to_addrs=MY_EMAIL,
-                msg=f"Subject: New Message from Walker's Blog\n\n"
-                    f"Name: {form.name.data}\n"
-                    f"Email: {form.email.data}\n"
-                    f"Message: {message}"
-            )
-        print("Message sent!!")
+        # Hand the email off to the Celery worker so the request doesn't wait on SMTP
+        send_contact_email.delay(form.name.data, form.email.data, message)
         return render_template("contact.html", form=form, heading="Successfully Sent Your Message.")
     else:
         return render_template("contact.html", form=form, heading="Contact Me")
@@ -245,17 +509,18 @@ def contact():
 def add_new_post():
     form = CreatePostForm()
     if form.validate_on_submit():
-        new_post = BlogPost(
-            author_id=current_user.id,
-            title=form.title.data,
-            subtitle=form.subtitle.data,
-            body=form.body.data,
-            img_url=form.img_url.data,
-            date=date.today().strftime("%B %d, %Y")
+        db.session.execute(
+            insert(BlogPost).values(
+                author_id=current_user.id,
+                title=form.title.data,
+                subtitle=form.subtitle.data,
+                body=form.body.data,
+                img_url=form.img_url.data,
+                date=date.today()
+            )
         )
-
-        db.session.add(new_post)
         db.session.commit()
+        cache.delete(HOMEPAGE_CACHE_KEY)
 
         return redirect(url_for("get_all_posts"))
     return render_template("make-post.html", form=form)
@@ -265,7 +530,7 @@ def add_new_post():
 @login_required
 @admin_only
 def edit_post(post_id):
-    post = BlogPost.query.get(post_id)
+    post = get_post_or_404(post_id)
     edit_form = CreatePostForm(
         title=post.title,
         subtitle=post.subtitle,
@@ -280,6 +545,7 @@ def edit_post(post_id):
 
         post.body = edit_form.body.data
         db.session.commit()
+        cache.delete(HOMEPAGE_CACHE_KEY)
         return redirect(url_for("show_post", post_id=post.id))
 
     return render_template("make-post.html", form=edit_form, admin_id=admin_id, edit=True)
@@ -289,9 +555,10 @@ def edit_post(post_id):
 @login_required
 @admin_only
 def delete_post(post_id):
-    post_to_delete = BlogPost.query.get(post_id)
+    post_to_delete = get_post_or_404(post_id)
     db.session.delete(post_to_delete)
     db.session.commit()
+    cache.delete(HOMEPAGE_CACHE_KEY)
     return redirect(url_for('get_all_posts'))
 
 
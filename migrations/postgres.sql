@@ -0,0 +1,16 @@
+-- Schema changes for an existing Heroku Postgres database.
+-- New databases get all of this from db.create_all(), and the bundled blog.db is already up to date.
+--
+-- Run each section once, in order, outside a transaction (CREATE INDEX CONCURRENTLY can't run inside one):
+--     heroku pg:psql < migrations/postgres.sql
+
+-- Index the foreign keys used by the author joins and the comments selectin load
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_blog_posts_author_id ON blog_posts (author_id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_comments_author_id ON comments (author_id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_comments_post_id ON comments (post_id);
+
+-- Store post and comment dates as native DATE/TIME instead of formatted strings
+ALTER TABLE blog_posts ALTER COLUMN date TYPE DATE USING to_date(date, 'FMMonth DD, YYYY');
+ALTER TABLE comments ALTER COLUMN date TYPE DATE USING to_date(date, 'FMMonth DD, YYYY'),
+                     ALTER COLUMN time TYPE TIME USING time::time;
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_blog_posts_date ON blog_posts (date);